@@ -0,0 +1,151 @@
+import hashlib
+import os
+import pickle
+import random
+import re
+
+MERSENNE_PRIME = (1 << 61) - 1
+MAX_HASH = (1 << 32) - 1
+
+WORD_RE = re.compile(r'\w+')
+
+
+def normalize_text(text):
+    """
+    Приводит текст к виду для сравнения: нижний регистр, ё -> е, только слова.
+    :param text: Исходная строка (может быть None).
+    :return: Список слов.
+    """
+    if not text:
+        return []
+    return WORD_RE.findall(text.lower().replace('ё', 'е'))
+
+
+def advert_features(item, shingle_size=3):
+    """
+    Собирает набор признаков объявления для MinHash.
+    Описание режется на шинглы по shingle_size слов, адрес - на слова,
+    цена округляется до тысяч, координаты - до 3 знаков (~100 м).
+    :param item: AdvertItem (или dict с теми же ключами).
+    :param shingle_size: Количество слов в шингле описания.
+    :return: Множество строковых признаков.
+    """
+    features = set()
+
+    words = normalize_text(item.get('description'))
+    if len(words) < shingle_size:
+        if words:
+            features.add('d:' + ' '.join(words))
+    else:
+        for i in range(len(words) - shingle_size + 1):
+            features.add('d:' + ' '.join(words[i:i + shingle_size]))
+
+    for word in normalize_text(item.get('address')):
+        features.add('a:' + word)
+
+    price = item.get('price')
+    if price:
+        features.add(f'p:{round(price, -3)}')
+
+    lat, lon = item.get('lat'), item.get('lon')
+    if lat is not None and lon is not None:
+        features.add(f'g:{lat:.3f},{lon:.3f}')
+
+    return features
+
+
+class MinHasher:
+    """Считает MinHash-сигнатуры фиксированной длины для множеств строк."""
+
+    def __init__(self, num_perm=64, seed=1):
+        self.num_perm = num_perm
+        rnd = random.Random(seed)
+        self.perms = [
+            (rnd.randint(1, MERSENNE_PRIME - 1), rnd.randint(0, MERSENNE_PRIME - 1))
+            for _ in range(num_perm)
+        ]
+
+    def signature(self, features):
+        hashes = [
+            int.from_bytes(hashlib.blake2b(f.encode('utf-8'), digest_size=8).digest(), 'little')
+            for f in features
+        ]
+        return tuple(
+            min(((a * h + b) % MERSENNE_PRIME) & MAX_HASH for h in hashes)
+            for a, b in self.perms
+        )
+
+
+class LSHIndex:
+    """
+    LSH-индекс MinHash-сигнатур с разбиением на полосы (bands).
+    Каждое объявление получает cluster_id - id первого объявления своего кластера.
+    Поиск и вставка работают за время, не зависящее от размера индекса (кроме размера корзин).
+    """
+
+    def __init__(self, num_perm=64, bands=16, threshold=0.8):
+        if num_perm % bands:
+            raise ValueError(f"num_perm ({num_perm}) должен делиться на bands ({bands})")
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.threshold = threshold
+        self.buckets = [{} for _ in range(bands)]  # полоса -> {ключ полосы: [id]}
+        self.signatures = {}  # id -> сигнатура
+        self.clusters = {}  # id -> cluster_id
+
+    def __len__(self):
+        return len(self.signatures)
+
+    def _band_keys(self, signature):
+        for band in range(self.bands):
+            yield band, signature[band * self.rows:(band + 1) * self.rows]
+
+    @staticmethod
+    def similarity(sig_a, sig_b):
+        return sum(1 for a, b in zip(sig_a, sig_b) if a == b) / len(sig_a)
+
+    def query(self, signature):
+        """
+        Ищет самое похожее объявление в индексе.
+        :param signature: MinHash-сигнатура.
+        :return: id найденного объявления или None, если похожих выше порога нет.
+        """
+        candidates = set()
+        for band, key in self._band_keys(signature):
+            candidates.update(self.buckets[band].get(key, ()))
+
+        best_id, best_score = None, self.threshold
+        for candidate in candidates:
+            score = self.similarity(signature, self.signatures[candidate])
+            if score >= best_score:
+                best_id, best_score = candidate, score
+        return best_id
+
+    def add(self, advt_id, signature):
+        """
+        Добавляет объявление в индекс и возвращает его cluster_id.
+        Повторно добавленное объявление сохраняет прежний кластер.
+        """
+        if advt_id in self.clusters:
+            return self.clusters[advt_id]
+
+        match = self.query(signature)
+        cluster_id = self.clusters[match] if match is not None else advt_id
+
+        self.signatures[advt_id] = signature
+        self.clusters[advt_id] = cluster_id
+        for band, key in self._band_keys(signature):
+            self.buckets[band].setdefault(key, []).append(advt_id)
+        return cluster_id
+
+    def save(self, path):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(self, f, protocol=4)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            return pickle.load(f)
@@ -22,12 +22,15 @@ class AdvertItem(scrapy.Item):
     params = scrapy.Field()
     date_posted = scrapy.Field()
     is_active = scrapy.Field()
+    cluster_id = scrapy.Field() # id первого объявления кластера дубликатов, заполняет NearDuplicatePipeline
 
 # Переименовано image в ImageItem
 class ImageItem(scrapy.Item):
     advt_id = scrapy.Field()
     url = scrapy.Field()
     date_update = scrapy.Field()
+    content_hash = scrapy.Field() # sha256 содержимого, заполняет ImageStorePipeline
+    size = scrapy.Field() # размер файла в байтах
 
 # Переименовано phone в PhoneItem
 class PhoneItem(scrapy.Item):
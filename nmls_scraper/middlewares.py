@@ -1,7 +1,28 @@
+import logging
+import os
+import pickle
+import shutil
+import tempfile
+from collections import defaultdict
+from urllib.parse import urlparse
+
+import scrapy
+from queuelib import FifoDiskQueue
 from scrapy import signals
+from scrapy.exceptions import DontCloseSpider, NotConfigured
+from scrapy.utils.defer import deferred_from_coro
+from scrapy.utils.request import request_from_dict
 from itemadapter import ItemAdapter
 
 
+# отправляется перед тем, как отложенная страница списка уходит в планировщик;
+# обработчик возвращает False, если страница больше не нужна
+listing_release = object()
+
+# отправляется DownloadFailureDownloaderMiddleware, когда запрос окончательно не скачан
+download_failed = object()
+
+
 class NmlsScraperSpiderMiddleware:
     @classmethod
     def from_crawler(cls, crawler):
@@ -46,3 +67,603 @@ class NmlsScraperDownloaderMiddleware:
 
     def spider_opened(self, spider):
         spider.logger.info("Spider opened: %s" % spider.name)
+
+
+class DiskRequestQueues:
+    """
+    Очереди запросов на диске (FIFO), по одной на ключ.
+    Запросы сохраняются через Request.to_dict, поэтому колбэки должны быть методами паука.
+    """
+
+    def __init__(self, path, cleanup=False):
+        self.path = path
+        self.cleanup = cleanup
+        self.queues = {}
+
+    @staticmethod
+    def _dirname(key):
+        if isinstance(key, tuple):
+            return '_'.join(str(part) for part in key)
+        return str(key)
+
+    def queue(self, key):
+        queue = self.queues.get(key)
+        if queue is None:
+            queue = FifoDiskQueue(os.path.join(self.path, self._dirname(key)))
+            self.queues[key] = queue
+        return queue
+
+    def push(self, key, request, spider):
+        self.queue(key).push(pickle.dumps(request.to_dict(spider=spider), protocol=4))
+
+    def pop(self, key, spider):
+        data = self.queue(key).pop()
+        if data is None:
+            return None
+        return request_from_dict(pickle.loads(data), spider=spider)
+
+    def size(self, key):
+        queue = self.queues.get(key)
+        return len(queue) if queue is not None else 0
+
+    def keys(self):
+        return list(self.queues)
+
+    def open_existing(self):
+        """Открывает очереди, оставшиеся на диске от прошлого запуска; ключом становится имя каталога."""
+        if not os.path.isdir(self.path):
+            return
+        for name in sorted(os.listdir(self.path)):
+            if os.path.isfile(os.path.join(self.path, name, 'info.json')):
+                self.queue(name)
+
+    def close(self):
+        for queue in self.queues.values():
+            queue.close()
+        self.queues.clear()
+        if self.cleanup:
+            shutil.rmtree(self.path, ignore_errors=True)
+
+
+class DownloadFailureDownloaderMiddleware:
+    """
+    Отправляет сигнал download_failed, когда запрос окончательно не скачан
+    (ошибка соединения после всех повторов, IgnoreRequest и т.п.).
+    Стоит ниже RetryMiddleware, поэтому видит только отказы, которые уже не будут повторены.
+    """
+
+    def __init__(self, crawler):
+        self.crawler = crawler
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def process_exception(self, request, exception, spider=None):
+        self.crawler.signals.send_catch_log(
+            download_failed, request=request, exception=exception, spider=self.crawler.spider
+        )
+        return None
+
+
+class RegionQuotaSpiderMiddleware:
+    """
+    Делит общий бюджет объявлений (или запросов) между поддоменами регионов и их категориями.
+    Квота проверяется при планировании: страницы списка пропускаются, пока ожидаемое с них число
+    объявлений помещается в квоту области, остальные запросы откладываются на диск.
+    Квота, не израсходованная завершёнными областями, переходит к областям, где ещё есть работа,
+    и отложенные запросы этих областей возвращаются в планировщик.
+    Когда бюджет израсходован и запрошенные объявления получены, паук закрывается.
+    Счетчики квот не сохраняются в JOBDIR.
+    """
+
+    REGION_CALLBACK = 'parse_region_home'
+    LISTING_CALLBACK = 'parse_listing_page'
+    DETAIL_CALLBACK = 'parse_detail_page'
+    EPOCH_KEY = 'region_quota_epoch'
+    SETTLED_KEY = 'region_quota_settled'
+    # порядок возврата отложенных запросов: сначала объявления, затем страницы
+    KINDS = ('detail', 'listing', 'page')
+
+    def __init__(self, crawler, budget, mode='items', region_weights=None, category_weights=None,
+                 details_per_page=20, park_dir=None):
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.budget = budget
+        self.mode = mode
+        self.region_weights = {str(k): float(v) for k, v in (region_weights or {}).items()}
+        self.category_weights = {int(k): float(v) for k, v in (category_weights or {}).items()}
+        self.default_details_per_page = details_per_page
+
+        self.regions = {}  # регион -> {область: вес категории}
+        self.scheduled = defaultdict(int)  # область -> сколько запросов учтено в квоте
+        self.pending = defaultdict(int)  # область -> страницы категории/списка, ещё не обработанные
+        self.listings = defaultdict(int)  # область -> из них страниц списка
+        self.parked = defaultdict(int)  # (область, вид запроса) -> отложено на диск
+        self.done_scopes = set()
+        self.done_regions = set()
+        self.total = 0
+        self.details_inflight = 0
+        self.listing_pages_seen = 0
+        self.details_seen = 0
+        self.epoch = 0  # увеличивается, когда счетчики сбрасываются в простое
+        self.closing = False
+        self.releasing = False
+        self.parking = DiskRequestQueues(
+            park_dir or tempfile.mkdtemp(prefix='nmls_region_quota_'), cleanup=True
+        )
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        if not settings.getbool('REGION_QUOTA_ENABLED'):
+            raise NotConfigured
+        budget = settings.getint('REGION_QUOTA_BUDGET')
+        if budget <= 0:
+            raise NotConfigured("REGION_QUOTA_BUDGET должен быть больше 0")
+        mode = settings.get('REGION_QUOTA_MODE', 'items')
+        if mode not in ('items', 'requests'):
+            raise ValueError(f"REGION_QUOTA_MODE должен быть 'items' или 'requests', получено: {mode}")
+
+        if settings.getint('CLOSESPIDER_ITEMCOUNT'):
+            # CloseSpider считает и картинки с телефонами, обход остановится раньше, чем израсходуется бюджет
+            logging.warning("REGION_QUOTA_ENABLED вместе с CLOSESPIDER_ITEMCOUNT: паук сам остановится по REGION_QUOTA_BUDGET, CLOSESPIDER_ITEMCOUNT стоит выставить в 0")
+
+        s = cls(
+            crawler,
+            budget,
+            mode=mode,
+            region_weights=settings.getdict('REGION_QUOTA_REGION_WEIGHTS'),
+            category_weights=settings.getdict('REGION_QUOTA_CATEGORY_WEIGHTS'),
+            details_per_page=settings.getint('REGION_QUOTA_DETAILS_PER_PAGE', 20),
+        )
+        crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(s.spider_idle, signal=signals.spider_idle)
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(s.request_dropped, signal=signals.request_dropped)
+        crawler.signals.connect(s.download_failed, signal=download_failed)
+        crawler.signals.connect(s.release_listing, signal=listing_release)
+        return s
+
+    def process_spider_output(self, response, result, spider=None):
+        details = 0
+        for entry in result:
+            if isinstance(entry, scrapy.Request):
+                details += self._kind(entry) == 'detail'
+                if not self._admit(entry):
+                    continue
+            yield entry
+        self._response_done(response, details)
+
+    async def process_spider_output_async(self, response, result, spider=None):
+        details = 0
+        async for entry in result:
+            if isinstance(entry, scrapy.Request):
+                details += self._kind(entry) == 'detail'
+                if not self._admit(entry):
+                    continue
+            yield entry
+        self._response_done(response, details)
+
+    def process_spider_exception(self, response, exception, spider=None):
+        # HttpError и ошибки в колбэке: выдачи по этому ответу не будет
+        self._settle(response.request, 'failed')
+        return None
+
+    def spider_opened(self, spider):
+        spider.logger.info(f"квоты по регионам включены: бюджет {self.budget} ({self.mode})")
+
+    def spider_closed(self, spider):
+        self.parking.close()
+
+    def request_dropped(self, request, spider):
+        # например, повторный URL отброшен фильтром дубликатов
+        self._settle(request, 'dropped')
+
+    def download_failed(self, request, exception, spider):
+        self._settle(request, 'failed')
+
+    def spider_idle(self, spider):
+        # в простое ничего не выполняется: запросы без ответа считаются завершенными,
+        # освободившаяся квота отдается отложенным запросам
+        self.epoch += 1
+        self.details_inflight = 0
+        for scope in list(self.pending):
+            self.pending[scope] = 0
+            self.listings[scope] = 0
+            self._finish_if_idle(scope)
+        for region, cats in self.regions.items():
+            if not cats:
+                self.done_regions.add(region)
+        if self._release_parked():
+            raise DontCloseSpider
+
+    def release_listing(self, request, spider):
+        scope = self._scope(request.meta)
+        if scope is None:
+            return True
+        if request.meta.get(self.EPOCH_KEY) == self.epoch and not request.meta.get(self.SETTLED_KEY):
+            # страница уже учтена при планировании - решаем заново без ее учета
+            self._uncount(scope, 'listing')
+        else:
+            self._register_scope(scope)
+        decision = self._decide(scope, 'listing')
+        if decision == 'admit':
+            self._count(request, scope, 'listing')
+            return True
+        if decision == 'park':
+            self._park(request, scope, 'listing')
+        else:
+            self._drop(request, scope)
+        self._finish_if_idle(scope)
+        return False
+
+    def _kind(self, request):
+        callback = getattr(request.callback, '__name__', None)
+        if callback == self.DETAIL_CALLBACK:
+            return 'detail'
+        if callback == self.LISTING_CALLBACK:
+            return 'listing'
+        if callback == self.REGION_CALLBACK:
+            return 'region'
+        return 'page'
+
+    @staticmethod
+    def _scope(meta):
+        region = meta.get('region_domain')
+        cat_id = meta.get('cat_id')
+        if region is None or cat_id is None:
+            return None
+        return (region, cat_id, meta.get('advt_type_id'))
+
+    def _register_region(self, region):
+        self.regions.setdefault(region, {})
+        self.done_regions.discard(region)
+
+    def _register_scope(self, scope):
+        region = scope[0]
+        self._register_region(region)
+        cats = self.regions[region]
+        if scope not in cats:
+            cats[scope] = self.category_weights.get(scope[1], 1.0)
+        self.done_scopes.discard(scope)
+
+    def _parked_in(self, scope):
+        return sum(self.parked[(scope, kind)] for kind in self.KINDS)
+
+    def _finish_if_idle(self, scope):
+        if self.pending[scope] > 0 or self._parked_in(scope):
+            return
+        self.done_scopes.add(scope)
+        region = scope[0]
+        if all(s in self.done_scopes for s in self.regions[region]):
+            self.done_regions.add(region)
+
+    def _quota(self, scope):
+        region = scope[0]
+        spent = sum(
+            self.scheduled[s]
+            for r in self.done_regions
+            for s in self.regions[r]
+        )
+        region_weight_total = sum(
+            self.region_weights.get(r, 1.0) for r in self.regions if r not in self.done_regions
+        )
+        if region_weight_total <= 0:
+            return 0
+        region_budget = max(self.budget - spent, 0) * self.region_weights.get(region, 1.0) / region_weight_total
+
+        cats = self.regions[region]
+        cat_spent = sum(self.scheduled[s] for s in cats if s in self.done_scopes)
+        cat_weight_total = sum(w for s, w in cats.items() if s not in self.done_scopes)
+        if cat_weight_total <= 0:
+            return 0
+        return max(region_budget - cat_spent, 0) * cats[scope] / cat_weight_total
+
+    def _details_per_page(self):
+        if not self.listing_pages_seen:
+            return self.default_details_per_page
+        return max(self.details_seen / self.listing_pages_seen, 1)
+
+    def _decide(self, scope, kind):
+        """Решение по запросу области: 'admit' - в планировщик, 'park' - отложить, 'drop' - бюджет исчерпан."""
+        if self.total >= self.budget:
+            return 'drop'
+        quota = self._quota(scope)
+        if kind == 'detail' or self.mode == 'requests':
+            return 'admit' if self.scheduled[scope] < quota else 'park'
+        if kind == 'listing':
+            # объявления с уже запланированных страниц списка тоже займут квоту
+            expected = self.scheduled[scope] + self.listings[scope] * self._details_per_page()
+            return 'admit' if expected < quota else 'park'
+        return 'admit'
+
+    def _count(self, request, scope, kind):
+        request.meta[self.EPOCH_KEY] = self.epoch
+        request.meta.pop(self.SETTLED_KEY, None)
+        if kind == 'detail' or self.mode == 'requests':
+            self.scheduled[scope] += 1
+            self.total += 1
+            self.stats.inc_value(f'region_quota/scheduled_by_region/{scope[0]}')
+        if kind == 'detail':
+            self.details_inflight += 1
+        else:
+            self.pending[scope] += 1
+            if kind == 'listing':
+                self.listings[scope] += 1
+
+    def _uncount(self, scope, kind):
+        if kind == 'detail' or self.mode == 'requests':
+            self.scheduled[scope] -= 1
+            self.total -= 1
+        if kind == 'detail':
+            self.details_inflight -= 1
+        else:
+            self.pending[scope] -= 1
+            if kind == 'listing':
+                self.listings[scope] -= 1
+
+    def _park(self, request, scope, kind):
+        self.parking.push((scope, kind), request, self.crawler.spider)
+        self.parked[(scope, kind)] += 1
+        self.stats.inc_value('region_quota/parked')
+
+    def _drop(self, request, scope):
+        self.crawler.spider.logger.debug(f"бюджет квот исчерпан, запрос не создается: {request.url}")
+        self.stats.inc_value('region_quota/dropped')
+        self.stats.inc_value(f'region_quota/dropped_by_region/{scope[0]}')
+
+    def _admit(self, request):
+        kind = self._kind(request)
+        if kind == 'region':
+            if self.total >= self.budget:
+                return False
+            region = request.meta.get('region_domain')
+            if region:
+                self._register_region(region)
+            return True
+
+        scope = self._scope(request.meta)
+        if scope is None:
+            return self.total < self.budget
+        self._register_scope(scope)
+
+        decision = self._decide(scope, kind)
+        if decision == 'admit':
+            self._count(request, scope, kind)
+            return True
+        if decision == 'park':
+            self._park(request, scope, kind)
+        else:
+            self._drop(request, scope)
+            self._finish_if_idle(scope)
+        return False
+
+    def _release_parked(self):
+        """Возвращает в планировщик отложенные запросы, для которых освободилась квота."""
+        if self.releasing or self.closing:
+            return 0
+        self.releasing = True
+        released = 0
+        try:
+            for scope, kind in [key for key, n in self.parked.items() if n]:
+                key = (scope, kind)
+                while self.parked[key]:
+                    decision = self._decide(scope, kind)
+                    if decision == 'park':
+                        break
+                    request = self.parking.pop(key, self.crawler.spider)
+                    self.parked[key] -= 1
+                    if request is None:
+                        self.parked[key] = 0
+                        break
+                    if decision == 'drop':
+                        self._drop(request, scope)
+                        continue
+                    self._count(request, scope, kind)
+                    self.stats.inc_value('region_quota/released')
+                    self.crawler.engine.crawl(request)
+                    released += 1
+                self._finish_if_idle(scope)
+        finally:
+            self.releasing = False
+        return released
+
+    def _response_done(self, response, details):
+        if self._kind(response.request) == 'listing':
+            self.listing_pages_seen += 1
+            self.details_seen += details
+        self._settle(response.request, 'done')
+
+    def _settle(self, request, outcome):
+        """
+        Учитывает, что запрос завершен: получен ответ ('done'), ответ или загрузка без выдачи ('failed')
+        или запрос отброшен до загрузки ('dropped').
+        """
+        if request is None:
+            return
+        meta = request.meta
+        kind = self._kind(request)
+
+        if kind == 'region':
+            region = meta.get('region_domain', urlparse(request.url).netloc.split('.')[0])
+            # у региона не нашлось ни одной категории - его доля уходит остальным
+            if region in self.regions and not self.regions[region]:
+                self.done_regions.add(region)
+                self._release_parked()
+            return
+
+        if meta.get(self.EPOCH_KEY) != self.epoch or meta.get(self.SETTLED_KEY):
+            return
+        meta[self.SETTLED_KEY] = True
+        scope = self._scope(meta)
+        if scope is None:
+            return
+
+        counted = kind == 'detail' or self.mode == 'requests'
+        # отброшенный запрос ничего не стоил, объявление без ответа не получено - место в квоте возвращается
+        if counted and (outcome == 'dropped' or (outcome == 'failed' and self.mode == 'items')):
+            self.scheduled[scope] -= 1
+            self.total -= 1
+
+        if kind == 'detail':
+            self.details_inflight -= 1
+        else:
+            self.pending[scope] -= 1
+            if kind == 'listing':
+                self.listings[scope] -= 1
+            self._finish_if_idle(scope)
+
+        self._release_parked()
+        if kind == 'detail':
+            self._close_if_spent()
+
+    def _close_if_spent(self):
+        if self.closing or self.total < self.budget or self.details_inflight > 0:
+            return
+        self.closing = True
+        spider = self.crawler.spider
+        spider.logger.info(f"бюджет квот израсходован ({self.total} из {self.budget}), паук закрывается")
+        engine = self.crawler.engine
+        if hasattr(engine, 'close_spider_async'):
+            deferred_from_coro(engine.close_spider_async(reason='region_quota_spent'))
+        else:
+            engine.close_spider(spider, 'region_quota_spent')
+
+
+class ListingOverflowSpiderMiddleware:
+    """
+    Ограничивает число ожидающих страниц списка на регион.
+    Лишние страницы уходят в очередь на диске и возвращаются в работу в порядке номеров страниц
+    по мере обработки уже запланированных, поэтому очередь планировщика не растет вместе с категорией.
+    """
+
+    LISTING_CALLBACK = 'parse_listing_page'
+
+    def __init__(self, crawler, max_pending, queue_dir, cleanup=False):
+        self.crawler = crawler
+        self.max_pending = max_pending
+        self.pending = defaultdict(int)  # регион -> страницы списка в планировщике
+        self.queues = DiskRequestQueues(queue_dir, cleanup=cleanup)  # регион -> отложенные страницы
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        max_pending = settings.getint('LISTING_MAX_PENDING_PER_REGION')
+        if max_pending <= 0:
+            raise NotConfigured
+
+        queue_dir = settings.get('LISTING_OVERFLOW_DIR')
+        cleanup = False
+        if not queue_dir:
+            jobdir = settings.get('JOBDIR')
+            if jobdir:
+                queue_dir = os.path.join(jobdir, 'listing_overflow')
+            else:
+                queue_dir = tempfile.mkdtemp(prefix='nmls_listing_overflow_')
+                cleanup = True
+
+        s = cls(crawler, max_pending, queue_dir, cleanup=cleanup)
+        crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(s.spider_idle, signal=signals.spider_idle)
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(s.request_dropped, signal=signals.request_dropped)
+        crawler.signals.connect(s.download_failed, signal=download_failed)
+        return s
+
+    def process_spider_output(self, response, result, spider=None):
+        for entry in result:
+            if self._defer(entry):
+                continue
+            yield entry
+        yield from self._listing_done(response.request)
+
+    async def process_spider_output_async(self, response, result, spider=None):
+        async for entry in result:
+            if self._defer(entry):
+                continue
+            yield entry
+        for request in self._listing_done(response.request):
+            yield request
+
+    def process_spider_exception(self, response, exception, spider=None):
+        # HttpError или ошибка в колбэке: место страницы освобождается сразу. Отложенные страницы
+        # отдаются движку напрямую - возвращенный результат прервал бы обработку исключения
+        self._crawl(self._listing_done(response.request))
+        return None
+
+    def request_dropped(self, request, spider):
+        self._crawl(self._listing_done(request))
+
+    def download_failed(self, request, exception, spider):
+        self._crawl(self._listing_done(request))
+
+    def _defer(self, entry):
+        """Откладывает страницу списка на диск, если у региона уже достаточно страниц в планировщике."""
+        if not (isinstance(entry, scrapy.Request) and self._is_listing(entry)):
+            return False
+        region = entry.meta.get('region_domain', 'unknown_region')
+        # пока в очереди есть страницы, новые встают за ними, чтобы сохранить порядок
+        if self.pending[region] >= self.max_pending or self.queues.size(region):
+            self.queues.push(region, entry, self.crawler.spider)
+            self.crawler.stats.inc_value('listing_overflow/pushed')
+            return True
+        self._track(region)
+        return False
+
+    def _listing_done(self, request):
+        if request is not None and self._is_listing(request):
+            region = request.meta.get('region_domain', 'unknown_region')
+            self.pending[region] = max(self.pending[region] - 1, 0)
+            yield from self._release(region)
+
+    def _crawl(self, requests):
+        for request in list(requests):
+            self.crawler.engine.crawl(request)
+
+    def spider_opened(self, spider):
+        # после возобновления по JOBDIR отложенные страницы остались на диске - открываем их очереди,
+        # чтобы они вернулись в работу в простое, даже если регион больше не встретится в выдаче
+        self.queues.open_existing()
+        for region in self.queues.keys():
+            size = self.queues.size(region)
+            if size:
+                spider.logger.info(f"очередь отложенных страниц региона {region}: {size} стр.")
+
+    def spider_idle(self, spider):
+        # ответы на часть страниц могли не прийти - в простое ничего не ожидает
+        released = False
+        for region in self.queues.keys():
+            self.pending[region] = 0
+            for request in self._release(region):
+                self.crawler.engine.crawl(request)
+                released = True
+        if released:
+            raise DontCloseSpider
+
+    def spider_closed(self, spider):
+        self.queues.close()
+
+    def _is_listing(self, request):
+        return getattr(request.callback, '__name__', None) == self.LISTING_CALLBACK
+
+    def _track(self, region):
+        self.pending[region] += 1
+        self.crawler.stats.max_value('listing_overflow/peak_pending', sum(self.pending.values()))
+
+    def _release(self, region):
+        spider = self.crawler.spider
+        while self.pending[region] < self.max_pending:
+            request = self.queues.pop(region, spider)
+            if request is None:
+                break
+            if not self._release_allowed(request, spider):
+                self.crawler.stats.inc_value('listing_overflow/discarded')
+                continue
+            self._track(region)
+            self.crawler.stats.inc_value('listing_overflow/released')
+            yield request
+
+    def _release_allowed(self, request, spider):
+        results = self.crawler.signals.send_catch_log(listing_release, request=request, spider=spider)
+        return all(result is not False for _, result in results)
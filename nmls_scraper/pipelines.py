@@ -1,7 +1,17 @@
 import psycopg2
 import logging
-from scrapy.exceptions import DropItem
+import hashlib
+import json
+import os
+import tempfile
+from collections import deque
+import scrapy
+from twisted.internet import defer, threads
+from scrapy import signals
+from scrapy.exceptions import DropItem, NotConfigured, StopDownload
+from scrapy.utils.defer import deferred_from_coro, maybe_deferred_to_future
 from nmls_scraper.items import AdvertItem, ImageItem, PhoneItem
+from nmls_scraper.dedup import LSHIndex, MinHasher, advert_features
 
 class NmlsScraperPipeline:
 
@@ -75,9 +85,15 @@ class NmlsScraperPipeline:
         return item
 
     def insert_or_update_advt(self, item):
+        # cluster_id заполняет только NearDuplicatePipeline; без него запрос подходит и для старой схемы таблицы
+        with_cluster = item.get('cluster_id') is not None
+        cluster_column = ', cluster_id' if with_cluster else ''
+        cluster_value = ', %s' if with_cluster else ''
+        cluster_update = ',\n            cluster_id = EXCLUDED.cluster_id' if with_cluster else ''
+
         sql = f"""
-        INSERT INTO {self.advt_table} (id, url, title, price, date_update, is_company, contactname, company, region, city, address, description, advt_type, source, cat, lat, lon, params, date_posted, is_active)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+        INSERT INTO {self.advt_table} (id, url, title, price, date_update, is_company, contactname, company, region, city, address, description, advt_type, source, cat, lat, lon, params, date_posted, is_active{cluster_column})
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s{cluster_value})
         ON CONFLICT (id)
         DO UPDATE SET
             title = EXCLUDED.title,
@@ -97,30 +113,41 @@ class NmlsScraperPipeline:
             lon = EXCLUDED.lon,
             params = EXCLUDED.params,
             date_posted = EXCLUDED.date_posted,
-            is_active = EXCLUDED.is_active;
+            is_active = EXCLUDED.is_active{cluster_update};
         """
-        self.cursor.execute(sql, (
+        params = (
             item.get('id'), item.get('url'), item.get('title'), item.get('price'), item.get('date_update'),
             item.get('is_company'), item.get('contactname'), item.get('company'), item.get('region'),
             item.get('city'), item.get('address'), item.get('description'), item.get('advt_type'),
             item.get('source'), item.get('cat'), item.get('lat'), item.get('lon'),
             item.get('params'),
             item.get('date_posted'), item.get('is_active'),
-        ))
+        )
+        if with_cluster:
+            params += (item.get('cluster_id'),)
+        self.cursor.execute(sql, params)
         self.connection.commit()
 
 
     def insert_image(self, item):
+        columns = ['advt_id', 'url', 'date_update']
+        # хеш и размер заполняет только ImageStorePipeline; без него запрос подходит и для старой схемы таблицы
+        extra_columns = ['content_hash', 'size'] if item.get('content_hash') is not None else []
+        columns += extra_columns
+
+        if extra_columns:
+            # Хеш и размер дописываем, если картинку скачали позже
+            conflict_action = 'DO UPDATE SET ' + ', '.join(f'{c} = EXCLUDED.{c}' for c in extra_columns)
+        else:
+            conflict_action = 'DO NOTHING' # Если уже есть, ничего не делаем
 
         sql = f"""
-        INSERT INTO {self.images_table} (advt_id, url, date_update)
-        VALUES (%s, %s, %s)
+        INSERT INTO {self.images_table} ({', '.join(columns)})
+        VALUES ({', '.join(['%s'] * len(columns))})
         ON CONFLICT (advt_id, url) -- Предполагаем уникальность пары объявление+URL изображения
-        DO NOTHING; -- Если уже есть, ничего не делаем
+        {conflict_action};
         """
-        self.cursor.execute(sql, (
-            item.get('advt_id'), item.get('url'), item.get('date_update'),
-        ))
+        self.cursor.execute(sql, [item.get(c) for c in columns])
         self.connection.commit()
 
 
@@ -136,4 +163,294 @@ class NmlsScraperPipeline:
         self.cursor.execute(sql, (
             item.get('advt_id'), phone_value, item.get('is_fake'), item.get('date_update'),
         ))
-        self.connection.commit()
\ No newline at end of file
+        self.connection.commit()
+
+
+class ByteBudget:
+    """Ограничивает суммарный объем байт, которые одновременно находятся в загрузке."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.waiting = deque()
+
+    def acquire(self, size):
+        size = min(size, self.limit)
+        d = defer.Deferred()
+        if not self.waiting and self.used + size <= self.limit:
+            self.used += size
+            d.callback(size)
+        else:
+            self.waiting.append((size, d))
+        return d
+
+    def release(self, size):
+        self.used -= size
+        self._wake()
+
+    def try_adjust(self, old_size, new_size):
+        """
+        Меняет уже выданный резерв, когда стал известен настоящий размер.
+        Увеличение, которое не помещается в лимит, не выполняется - возвращается False.
+        """
+        if new_size > old_size and self.used - old_size + new_size > self.limit:
+            return False
+        self.used += new_size - old_size
+        self._wake()
+        return True
+
+    def _wake(self):
+        while self.waiting and self.used + self.waiting[0][0] <= self.limit:
+            size, d = self.waiting.popleft()
+            self.used += size
+            d.callback(size)
+
+
+class ImageStorePipeline:
+    """
+    Параллельно скачивает картинки объявлений через движок Scrapy и сохраняет их на диск по sha256 содержимого.
+    Уже известные URL не скачиваются, одинаковые по содержимому файлы хранятся один раз.
+    Хеш и размер записываются в ImageItem и дальше попадают в таблицу images.
+    Объем одновременных загрузок ограничен по Content-Length; пока заголовки не получены,
+    резервируется средний размер уже скачанных картинок.
+    """
+
+    index_name = 'index.jsonl'
+    reserved_key = 'image_store_reserved'
+    initial_estimate = 256 * 1024
+    budget_attempts = 2  # вторая попытка - с резервом под размер из заголовков первой
+
+    def __init__(self, crawler, store_dir, max_size, max_inflight_bytes):
+        self.crawler = crawler
+        self.store_dir = store_dir
+        self.max_size = max_size
+        self.budget = ByteBudget(max_inflight_bytes)
+        self.downloaded_bytes = 0
+        self.downloaded_count = 0
+        self.urls = {}  # url -> (content_hash, size)
+        self.hashes = set()
+        self.inflight = {}  # url -> ожидающие той же загрузки
+        self.index_file = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        store_dir = settings.get('IMAGE_STORE_DIR')
+        if not store_dir:
+            raise NotConfigured("IMAGE_STORE_DIR не задан, картинки не скачиваются")
+        max_size = settings.getint('IMAGE_MAX_SIZE', 10 * 1024 * 1024)
+        max_inflight_bytes = settings.getint('IMAGE_MAX_INFLIGHT_BYTES', 64 * 1024 * 1024)
+        pipeline = cls(crawler, store_dir, max_size, max(max_inflight_bytes, max_size))
+        crawler.signals.connect(pipeline.headers_received, signal=signals.headers_received)
+        return pipeline
+
+    def open_spider(self, spider=None):
+        os.makedirs(self.store_dir, exist_ok=True)
+        index_path = os.path.join(self.store_dir, self.index_name)
+        if os.path.exists(index_path):
+            with open(index_path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # недописанная строка после аварийной остановки
+                    self.urls[record['url']] = (record['hash'], record['size'])
+                    self.hashes.add(record['hash'])
+        self.index_file = open(index_path, 'a', encoding='utf-8')
+        logging.info(f"Хранилище картинок: {self.store_dir}, известно {len(self.urls)} URL и {len(self.hashes)} файлов.")
+
+    def close_spider(self, spider=None):
+        if self.index_file:
+            self.index_file.close()
+
+    def headers_received(self, headers, body_length, request, spider):
+        reserved = request.meta.get(self.reserved_key)
+        if reserved is None:
+            return
+        # body_length = -1, если сервер не прислал Content-Length
+        size = min(body_length, self.max_size) if body_length >= 0 else self.max_size
+        if not self.budget.try_adjust(reserved['size'], size):
+            # картинка не помещается в свободный объем - загрузка прерывается до тела
+            # и повторяется, когда удастся зарезервировать настоящий размер
+            if size <= self.budget.limit:
+                reserved['needed'] = size
+            raise StopDownload(fail=True)
+        reserved['size'] = size
+
+    def size_estimate(self):
+        if not self.downloaded_count:
+            return min(self.initial_estimate, self.max_size)
+        return min(self.downloaded_bytes // self.downloaded_count, self.max_size)
+
+    async def process_item(self, item, spider=None):
+        if not isinstance(item, ImageItem) or not item.get('url'):
+            return item
+        return await maybe_deferred_to_future(self.fetch_image(item))
+
+    @defer.inlineCallbacks
+    def fetch_image(self, item):
+        url = item['url']
+        stats = self.crawler.stats
+        if url in self.urls:
+            stats.inc_value('images/url_known')
+        elif url in self.inflight:
+            # тот же URL уже скачивается для другого объявления
+            waiter = defer.Deferred()
+            self.inflight[url].append(waiter)
+            yield waiter
+        else:
+            self.inflight[url] = []
+            try:
+                yield self.download(url)
+            finally:
+                for waiter in self.inflight.pop(url):
+                    waiter.callback(None)
+
+        if url in self.urls:
+            item['content_hash'], item['size'] = self.urls[url]
+        return item
+
+    @defer.inlineCallbacks
+    def download(self, url):
+        stats = self.crawler.stats
+        try:
+            response, reserved = yield self.budgeted_download(url)
+        except Exception as e:
+            stats.inc_value('images/failed')
+            logging.warning(f"Не удалось скачать изображение {url}: {e}")
+            return
+        try:
+            if response.status != 200 or not response.body:
+                stats.inc_value('images/failed')
+                logging.warning(f"Изображение {url} не скачано: статус {response.status}")
+                return
+
+            try:
+                content_hash, size, stored = yield threads.deferToThread(self.store, response.body)
+            except OSError as e:
+                stats.inc_value('images/failed')
+                logging.error(f"Не удалось сохранить изображение {url}: {e}")
+                return
+        finally:
+            self.budget.release(reserved['size'])
+
+        stats.inc_value('images/downloaded')
+        stats.inc_value('images/stored' if stored else 'images/hash_known')
+        self.downloaded_bytes += size
+        self.downloaded_count += 1
+        self.urls[url] = (content_hash, size)
+        self.hashes.add(content_hash)
+        self.index_file.write(json.dumps({'url': url, 'hash': content_hash, 'size': size}) + '\n')
+        self.index_file.flush()
+
+    @defer.inlineCallbacks
+    def budgeted_download(self, url):
+        """
+        Скачивает картинку, удерживая резерв в ByteBudget; возвращает ответ и резерв,
+        который вызывающий освобождает, когда тело больше не нужно.
+        """
+        size = self.size_estimate()
+        for attempt in range(self.budget_attempts):
+            granted = yield self.budget.acquire(size)
+            # словарь в meta общий для повторов запроса (RetryMiddleware копирует meta поверхностно)
+            reserved = {'size': granted, 'needed': None}
+            request = scrapy.Request(
+                url, dont_filter=True,
+                meta={'download_maxsize': self.max_size, self.reserved_key: reserved},
+            )
+            try:
+                response = yield self.engine_download(request)
+            except StopDownload:
+                self.budget.release(reserved['size'])
+                if reserved['needed'] is None or attempt + 1 == self.budget_attempts:
+                    raise
+                self.crawler.stats.inc_value('images/budget_retries')
+                size = reserved['needed']
+                continue
+            except Exception:
+                self.budget.release(reserved['size'])
+                raise
+            return response, reserved
+
+    def engine_download(self, request):
+        engine = self.crawler.engine
+        if hasattr(engine, 'download_async'):
+            return deferred_from_coro(engine.download_async(request))
+        return engine.download(request)
+
+    def file_path(self, content_hash):
+        return os.path.join(self.store_dir, content_hash[:2], content_hash[2:4], content_hash)
+
+    def store(self, body):
+        content_hash = hashlib.sha256(body).hexdigest()
+        path = self.file_path(content_hash)
+        if content_hash in self.hashes or os.path.exists(path):
+            return content_hash, len(body), False
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), suffix='.part', delete=False) as f:
+            f.write(body)
+            tmp_path = f.name
+        os.replace(tmp_path, path)  # файл появляется целиком, недописанных копий в хранилище нет
+        return content_hash, len(body), True
+
+
+class NearDuplicatePipeline:
+    """
+    Помечает объявления-дубликаты (одна и та же квартира под разными /id или в соседних регионах).
+    По описанию, адресу, цене и координатам считается MinHash-сигнатура и ищется в LSH-индексе,
+    объявление получает cluster_id - id первого объявления своего кластера.
+    """
+
+    def __init__(self, crawler, index_path, num_perm, bands, threshold):
+        self.crawler = crawler
+        self.index_path = index_path
+        self.hasher = MinHasher(num_perm)
+        self.bands = bands
+        self.threshold = threshold
+        self.index = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        if not settings.getbool('DEDUP_ENABLED'):
+            raise NotConfigured
+        return cls(
+            crawler,
+            settings.get('DEDUP_INDEX_PATH'),
+            settings.getint('DEDUP_NUM_PERM', 64),
+            settings.getint('DEDUP_BANDS', 16),
+            settings.getfloat('DEDUP_THRESHOLD', 0.8),
+        )
+
+    def open_spider(self, spider=None):
+        if self.index_path and os.path.exists(self.index_path):
+            index = LSHIndex.load(self.index_path)
+            if index.num_perm == self.hasher.num_perm and index.bands == self.bands:
+                index.threshold = self.threshold
+                self.index = index
+                logging.info(f"Загружен индекс дубликатов: {len(index)} объявлений из {self.index_path}.")
+            else:
+                logging.warning(f"Параметры индекса дубликатов {self.index_path} не совпадают с настройками, индекс строится заново.")
+        if self.index is None:
+            self.index = LSHIndex(self.hasher.num_perm, self.bands, self.threshold)
+
+    def close_spider(self, spider=None):
+        if self.index_path and self.index is not None:
+            self.index.save(self.index_path)
+            logging.info(f"Индекс дубликатов сохранен: {len(self.index)} объявлений в {self.index_path}.")
+
+    def process_item(self, item, spider=None):
+        if not isinstance(item, AdvertItem):
+            return item
+
+        features = advert_features(item)
+        if not features:
+            item['cluster_id'] = item.get('id')
+            return item
+
+        item['cluster_id'] = self.index.add(item['id'], self.hasher.signature(features))
+        if item['cluster_id'] != item['id']:
+            self.crawler.stats.inc_value('dedup/duplicates')
+            logging.debug(f"Объявление {item['id']} - дубликат кластера {item['cluster_id']}")
+        return item
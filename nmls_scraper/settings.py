@@ -4,10 +4,31 @@ NEWSPIDER_MODULE = 'nmls_scraper.spiders'
 USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36' 
 ROBOTSTXT_OBEY = True # проверять согласно robots.txt
 DOWNLOAD_DELAY = 1 
-CLOSESPIDER_ITEMCOUNT = 1000  # количество объявлений 
+
+# равномерное распределение бюджета по регионам и категориям
+REGION_QUOTA_ENABLED = False # <-- True, чтобы делить бюджет между поддоменами регионов и категориями
+REGION_QUOTA_BUDGET = 1000 # общий бюджет: количество объявлений ('items') или запросов ('requests')
+REGION_QUOTA_MODE = 'items' # 'items' - считаются запросы объявлений, 'requests' - все запросы категорий
+REGION_QUOTA_REGION_WEIGHTS = {} # веса регионов, например {'nn': 2}; по умолчанию 1
+REGION_QUOTA_CATEGORY_WEIGHTS = {} # веса категорий по cat_id, например {1: 3}; по умолчанию 1
+REGION_QUOTA_DETAILS_PER_PAGE = 20 # сколько объявлений ожидать со страницы списка, пока нет своей статистики
+
+# количество объявлений; при включенных квотах паук останавливается сам по REGION_QUOTA_BUDGET,
+# а CLOSESPIDER_ITEMCOUNT (считает и картинки с телефонами) отключается
+CLOSESPIDER_ITEMCOUNT = 0 if REGION_QUOTA_ENABLED else 1000
 ITEM_PIPELINES = {
+   'nmls_scraper.pipelines.ImageStorePipeline': 200,
+   'nmls_scraper.pipelines.NearDuplicatePipeline': 250,
    'nmls_scraper.pipelines.NmlsScraperPipeline': 300,
 }
+# ниже RetryMiddleware (550): сообщает квотам об окончательно не скачанных запросах
+DOWNLOADER_MIDDLEWARES = {
+   'nmls_scraper.middlewares.DownloadFailureDownloaderMiddleware': 540,
+}
+SPIDER_MIDDLEWARES = {
+   'nmls_scraper.middlewares.ListingOverflowSpiderMiddleware': 540,
+   'nmls_scraper.middlewares.RegionQuotaSpiderMiddleware': 545,
+}
 AUTOTHROTTLE_ENABLED = True
 AUTOTHROTTLE_START_DELAY = 1
 AUTOTHROTTLE_MAX_DELAY = 60
@@ -16,6 +37,24 @@ AUTOTHROTTLE_MAX_DELAY = 60
 SPECIFIC_REGION = True # <-- Установите True, чтобы парсить только один регион
 SPECIFIC_REGION_SUBDOMAIN = 'nn' # <-- Укажите поддомен региона (например, 'nn' для Нижнего Новгорода). Используется только если SPECIFIC_REGION = True
 
+# порядок обхода: сначала объявления, затем страницы списков по порядку, затем разделы и регионы
+SCHEDULER_MEMORY_QUEUE = 'scrapy.squeues.FifoMemoryQueue'
+SCHEDULER_DISK_QUEUE = 'scrapy.squeues.PickleFifoDiskQueue'
+LISTING_MAX_PENDING_PER_REGION = 5 # сколько страниц списка на регион держать в планировщике, 0 - без ограничения
+LISTING_OVERFLOW_DIR = None # каталог очереди остальных страниц; по умолчанию JOBDIR/listing_overflow или временный
+
+# скачивание картинок объявлений
+IMAGE_STORE_DIR = None # <-- каталог хранилища картинок; None - картинки не скачиваются, сохраняется только URL
+IMAGE_MAX_SIZE = 10 * 1024 * 1024 # максимальный размер одной картинки, байт
+IMAGE_MAX_INFLIGHT_BYTES = 64 * 1024 * 1024 # сколько байт одновременно может быть в загрузке
+
+# поиск дубликатов объявлений (MinHash + LSH)
+DEDUP_ENABLED = False # <-- True, чтобы проставлять cluster_id (нужна колонка advt.cluster_id, см. readme)
+DEDUP_INDEX_PATH = None # <-- файл индекса для сохранения между запусками; None - индекс только в памяти
+DEDUP_NUM_PERM = 64 # длина сигнатуры
+DEDUP_BANDS = 16 # число полос LSH, DEDUP_NUM_PERM должно делиться на него
+DEDUP_THRESHOLD = 0.8 # минимальная оценка сходства Жаккара для дубликата
+
 DB_SETTINGS = {
     'database': 'tdata',
     'user': 'postgres',
@@ -13,6 +13,16 @@ class NmlsSpider(scrapy.Spider):
     name = 'nmls_spider'
     allowed_domains = ['nmls.ru']
 
+    # приоритеты: сначала объявления, затем страницы списков, затем разделы и регионы
+    DETAIL_PRIORITY = 20
+    LISTING_PRIORITY = 10
+    DISCOVERY_PRIORITY = 0
+
+    async def start(self):
+        # Scrapy 2.13+ вызывает start(); start_requests() оставлен для старых версий
+        for request in self.start_requests():
+            yield request
+
     def start_requests(self):
         settings = get_project_settings()
         crawl_specific = settings.getbool('SPECIFIC_REGION', False)
@@ -21,10 +31,10 @@ class NmlsSpider(scrapy.Spider):
         if crawl_specific and specific_subdomain:
             region_url = f'https://{specific_subdomain}.nmls.ru/'
             self.logger.info(f"парсинг только региона: {specific_subdomain}. начальный url: {region_url}")
-            yield scrapy.Request(url=region_url, callback=self.parse_region_home)
+            yield scrapy.Request(url=region_url, callback=self.parse_region_home, priority=self.DISCOVERY_PRIORITY)
         else:
             self.logger.info("парсинг всех регионов. начальный url: https://nmls.ru/")
-            yield scrapy.Request(url='https://nmls.ru/', callback=self.parse_regions)
+            yield scrapy.Request(url='https://nmls.ru/', callback=self.parse_regions, priority=self.DISCOVERY_PRIORITY)
 
     CAT_MAP = {
         'kvartir': 1, 'komnat': 2, 'domov': 3, 'zemelnyh-uchastkov': 4,
@@ -55,7 +65,7 @@ class NmlsSpider(scrapy.Spider):
                 seen_domains.add(domain)
                 region_url = f'{parsed_u.scheme}://{domain}/'
                 self.logger.info(f"найден домен: {domain}. переход на {region_url}")
-                yield scrapy.Request(region_url, self.parse_region_home, meta={'region_domain': domain.split('.')[0]})
+                yield scrapy.Request(region_url, self.parse_region_home, meta={'region_domain': domain.split('.')[0]}, priority=self.DISCOVERY_PRIORITY)
             except Exception as e:
                  self.logger.error(f"ошибка при обработке ссылки региона '{link}': {e}")
 
@@ -104,7 +114,8 @@ class NmlsSpider(scrapy.Spider):
                     'cat_id': cat_id,
                     'advt_type_id': advt_type_id,
                     'region_domain': region_domain # передаем дальше
-                }
+                },
+                priority=self.DISCOVERY_PRIORITY
             )
 
     def parse_category_pages(self, response):
@@ -138,13 +149,15 @@ class NmlsSpider(scrapy.Spider):
             yield scrapy.Request(
                 response.url,
                 self.parse_listing_page,
+                dont_filter=True, # тот же URL, что и у страницы категории - иначе отбросит фильтр дубликатов
                 meta={
                     'cat_id': cat_id,
                     'advt_type_id': advt_type_id,
                     'current_page': 1,
                     'total_pages': 1,
                     'region_domain': region_domain
-                }
+                },
+                priority=self.LISTING_PRIORITY
             )
         else:
             # инкрементируем счетчик категорий, для которых сгенерировали все страницы
@@ -169,7 +182,8 @@ class NmlsSpider(scrapy.Spider):
                         'current_page': page_num, 
                         'total_pages': last_page_num,
                         'region_domain': region_domain 
-                    }
+                    },
+                    priority=self.LISTING_PRIORITY
                 )
 
     def parse_listing_page(self, response):
@@ -205,7 +219,8 @@ class NmlsSpider(scrapy.Spider):
             yield scrapy.Request(
                 full_url,
                 self.parse_detail_page,
-                meta={'cat_id': cat_id, 'advt_type_id': advt_type_id, 'region_domain': region_domain}
+                meta={'cat_id': cat_id, 'advt_type_id': advt_type_id, 'region_domain': region_domain},
+                priority=self.DETAIL_PRIORITY
             )
 
     def parse_detail_page(self, response):
@@ -0,0 +1,105 @@
+import pytest
+
+from nmls_scraper.dedup import LSHIndex, MinHasher, advert_features
+
+DESCRIPTION = (
+    'Продается просторная двухкомнатная квартира в кирпичном доме на тихой улице рядом с парком. '
+    'Комнаты изолированные, окна выходят во двор, на кухне новый гарнитур и встроенная техника. '
+    'Санузел раздельный, в ванной свежий ремонт, установлены счетчики воды и тепла. '
+    'В шаговой доступности школа, детский сад, поликлиника, крупный торговый центр и остановка трамвая. '
+    'Во дворе детская площадка и парковка для жильцов, подъезд чистый, соседи спокойные. '
+    'Один взрослый собственник, документы готовы, возможна ипотека, показ в удобное время.'
+)
+
+
+def advert(advt_id, description=DESCRIPTION, address='Нижний Новгород, ул. Ванеева, 34',
+           price=5_200_000, lat=56.3012, lon=44.0334):
+    return {
+        'id': advt_id,
+        'description': description,
+        'address': address,
+        'price': price,
+        'lat': lat,
+        'lon': lon,
+    }
+
+
+def reposted(advt_id):
+    # то же объявление от другого агентства: другое слово в описании, цена и координаты в пределах округления
+    return advert(
+        advt_id,
+        description=DESCRIPTION.replace('тихой', 'спокойной'),
+        price=5_200_400,
+        lat=56.30122,
+        lon=44.03341,
+    )
+
+
+def other(advt_id):
+    return advert(
+        advt_id,
+        description='Сдается однокомнатная квартира у метро, мебель и техника есть, только на длительный срок.',
+        address='Нижний Новгород, ул. Родионова, 165',
+        price=25_000,
+        lat=56.3191,
+        lon=44.0803,
+    )
+
+
+@pytest.fixture
+def hasher():
+    return MinHasher(num_perm=64)
+
+
+def signature(hasher, item):
+    return hasher.signature(advert_features(item))
+
+
+def test_advert_features():
+    features = advert_features(advert('1'))
+    assert 'd:продается просторная двухкомнатная' in features
+    assert 'a:ванеева' in features
+    assert 'p:5200000' in features
+    assert 'g:56.301,44.033' in features
+    assert advert_features({}) == set()
+
+
+def test_signature_is_stable(hasher):
+    assert signature(hasher, advert('1')) == signature(MinHasher(num_perm=64), advert('1'))
+    assert len(signature(hasher, advert('1'))) == 64
+
+
+def test_near_duplicates_share_cluster(hasher):
+    index = LSHIndex(num_perm=64, bands=16, threshold=0.8)
+    assert index.add('1', signature(hasher, advert('1'))) == '1'
+    assert index.add('2', signature(hasher, reposted('2'))) == '1'
+    assert index.add('3', signature(hasher, other('3'))) == '3'
+    assert index.add('4', signature(hasher, other('4'))) == '3'
+    assert len(index) == 4
+
+
+def test_readded_advert_keeps_cluster(hasher):
+    index = LSHIndex(num_perm=64, bands=16, threshold=0.8)
+    index.add('1', signature(hasher, advert('1')))
+    index.add('2', signature(hasher, other('2')))
+    assert index.add('2', signature(hasher, advert('2'))) == '2'
+
+
+def test_bands_must_divide_num_perm():
+    with pytest.raises(ValueError):
+        LSHIndex(num_perm=64, bands=10)
+
+
+def test_saved_index_keeps_cluster_ids(tmp_path, hasher):
+    path = tmp_path / 'dedup.pickle'
+    index = LSHIndex(num_perm=64, bands=16, threshold=0.8)
+    index.add('1', signature(hasher, advert('1')))
+    index.add('2', signature(hasher, other('2')))
+    index.save(path)
+
+    loaded = LSHIndex.load(path)
+    assert loaded.clusters == index.clusters
+    # следующий запуск: новые копии попадают в кластеры, найденные в прошлый раз
+    assert loaded.add('3', signature(hasher, reposted('3'))) == '1'
+    assert loaded.add('4', signature(hasher, other('4'))) == '2'
+    assert loaded.add('1', signature(hasher, advert('1'))) == '1'
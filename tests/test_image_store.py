@@ -0,0 +1,157 @@
+import hashlib
+import os
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+scrapy = pytest.importorskip('scrapy')
+
+from scrapy import signals
+from scrapy.crawler import CrawlerProcess
+from scrapy.exceptions import StopDownload
+from scrapy.utils.test import get_crawler
+
+from nmls_scraper.items import ImageItem
+from nmls_scraper.pipelines import ByteBudget, ImageStorePipeline
+
+PHOTO = b'\xff\xd8 agency photo ' * 512
+OTHER_PHOTO = b'\xff\xd8 another photo ' * 256
+
+BODIES = {
+    '/': b'<html></html>',
+    '/a.jpg': PHOTO,
+    '/b.jpg': PHOTO,  # та же фотография под другим URL
+    '/c.jpg': OTHER_PHOTO,
+}
+
+
+class ImageHandler(BaseHTTPRequestHandler):
+    hits = Counter()
+
+    def do_GET(self):
+        body = BODIES.get(self.path)
+        if body is None:
+            self.send_error(404)
+            return
+        self.hits[self.path] += 1
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ImagesSpider(scrapy.Spider):
+    name = 'images_test'
+
+    def __init__(self, base_url=None, **kwargs):
+        super().__init__(**kwargs)
+        self.base_url = base_url
+
+    async def start(self):
+        yield scrapy.Request(self.base_url + '/', self.parse)
+
+    def parse(self, response):
+        # /a.jpg встречается в двух объявлениях
+        for advt_id, path in (('1', '/a.jpg'), ('2', '/a.jpg'), ('3', '/b.jpg'), ('4', '/c.jpg')):
+            item = ImageItem()
+            item['advt_id'] = advt_id
+            item['url'] = self.base_url + path
+            yield item
+
+
+def test_image_store_pipeline(tmp_path):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ImageHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f'http://127.0.0.1:{server.server_port}'
+    store_dir = tmp_path / 'images'
+
+    items = []
+
+    def collect(item):
+        items.append(item)
+
+    process = CrawlerProcess(settings={
+        'ITEM_PIPELINES': {'nmls_scraper.pipelines.ImageStorePipeline': 200},
+        'IMAGE_STORE_DIR': str(store_dir),
+        'ROBOTSTXT_OBEY': False,
+        'TELNETCONSOLE_ENABLED': False,
+        'LOG_LEVEL': 'WARNING',
+    })
+    crawler = process.create_crawler(ImagesSpider)
+    crawler.signals.connect(collect, signal=signals.item_scraped)
+    try:
+        process.crawl(crawler, base_url=base_url)
+        process.start()
+    finally:
+        server.shutdown()
+
+    # каждый URL скачан один раз, хотя /a.jpg пришел в двух объявлениях
+    assert ImageHandler.hits['/a.jpg'] == 1
+    assert ImageHandler.hits['/b.jpg'] == 1
+    assert ImageHandler.hits['/c.jpg'] == 1
+
+    # одинаковое содержимое хранится одним файлом
+    stored = [
+        name for _, _, files in os.walk(store_dir) for name in files
+        if name != 'index.jsonl'
+    ]
+    assert sorted(stored) == sorted({
+        hashlib.sha256(PHOTO).hexdigest(),
+        hashlib.sha256(OTHER_PHOTO).hexdigest(),
+    })
+
+    assert len(items) == 4
+    for item in items:
+        body = BODIES[item['url'][len(base_url):]]
+        assert item['content_hash'] == hashlib.sha256(body).hexdigest()
+        assert item['size'] == len(body)
+
+
+def test_byte_budget_never_exceeds_limit():
+    budget = ByteBudget(100)
+    first = budget.acquire(60)
+    second = budget.acquire(60)
+    assert first.called and not second.called
+
+    # настоящий размер больше резерва и не помещается - резерв не меняется
+    assert not budget.try_adjust(60, 120)
+    assert budget.used == 60
+
+    # уменьшение освободило место для ожидающего
+    assert budget.try_adjust(60, 30)
+    assert second.called
+    assert budget.used == 90
+    assert not budget.try_adjust(30, 50)
+    budget.release(30)
+    budget.release(60)
+    assert budget.used == 0
+
+
+def test_headers_over_budget_stop_download(tmp_path):
+    crawler = get_crawler(settings_dict={
+        'IMAGE_STORE_DIR': str(tmp_path),
+        'IMAGE_MAX_SIZE': 100,
+        'IMAGE_MAX_INFLIGHT_BYTES': 100,
+    })
+    pipeline = ImageStorePipeline.from_crawler(crawler)
+    other = pipeline.budget.acquire(50)
+    assert other.called
+    granted = []
+    pipeline.budget.acquire(40).addCallback(granted.append)
+
+    reserved = {'size': granted[0], 'needed': None}
+    request = scrapy.Request('http://example.com/a.jpg', meta={pipeline.reserved_key: reserved})
+    with pytest.raises(StopDownload):
+        pipeline.headers_received({}, 80, request, None)
+    # загрузка повторится с резервом под настоящий размер
+    assert reserved == {'size': 40, 'needed': 80}
+    assert pipeline.budget.used == 90
+
+    pipeline.headers_received({}, 30, request, None)
+    assert reserved['size'] == 30
+    assert pipeline.budget.used == 80
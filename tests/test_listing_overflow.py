@@ -0,0 +1,147 @@
+import pytest
+
+scrapy = pytest.importorskip('scrapy')
+
+from scrapy.core.scheduler import Scheduler
+from scrapy.exceptions import DontCloseSpider
+from scrapy.http import HtmlResponse
+from scrapy.utils.test import get_crawler
+
+from nmls_scraper.middlewares import ListingOverflowSpiderMiddleware
+from nmls_scraper.spiders.nmls_spider import NmlsSpider
+
+HOME = 'https://nn.nmls.ru/'
+CATEGORY = 'https://nn.nmls.ru/prodazha-kvartir'
+PAGES = 6
+ADS_PER_PAGE = 2
+
+
+def listing_url(page):
+    return f'{CATEGORY}?page={page}'
+
+
+def detail_url(page, n):
+    return f'https://nn.nmls.ru/prodazha-kvartir/id{page}{n}'
+
+
+SITE = {
+    HOME: '<div class="realty-filter"><a class="btn-category" href="/prodazha-kvartir">кв</a></div>',
+    CATEGORY: f'<a class="nav-last" href="?page={PAGES}">»</a>',
+}
+for page in range(1, PAGES + 1):
+    SITE[listing_url(page)] = ''.join(
+        f'<div class="object-title"><a href="{detail_url(page, n)}">x</a></div>'
+        for n in range(ADS_PER_PAGE)
+    )
+
+
+class SchedulerEngine:
+    """Вместо движка: запросы от middleware уходят прямо в планировщик."""
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+
+    def crawl(self, request):
+        self.scheduler.enqueue_request(request)
+
+
+def make_crawl(tmp_path, **settings):
+    crawler = get_crawler(NmlsSpider, {
+        'LISTING_MAX_PENDING_PER_REGION': 2,
+        'LISTING_OVERFLOW_DIR': str(tmp_path / 'overflow'),
+        'SCHEDULER_MEMORY_QUEUE': 'scrapy.squeues.FifoMemoryQueue',
+        'SCHEDULER_PRIORITY_QUEUE': 'scrapy.pqueues.ScrapyPriorityQueue',
+        **settings,
+    })
+    spider = NmlsSpider()
+    spider.crawler = crawler
+    crawler.spider = spider
+    scheduler = Scheduler.from_crawler(crawler)
+    scheduler.open(spider)
+    crawler.engine = SchedulerEngine(scheduler)
+    mw = ListingOverflowSpiderMiddleware.from_crawler(crawler)
+    mw.spider_opened(spider)
+    return crawler, mw
+
+
+def run(crawler, mw, start=(), max_listings=None):
+    """Обходит заглушку сайта по одному запросу за раз, как паук с CONCURRENT_REQUESTS = 1."""
+    spider = crawler.spider
+    scheduler = crawler.engine.scheduler
+    for request in start:
+        scheduler.enqueue_request(request)
+    fetched = []
+    while True:
+        request = scheduler.next_request()
+        if request is None:
+            try:
+                mw.spider_idle(spider)
+            except DontCloseSpider:
+                continue
+            break
+        fetched.append(request.url)
+        if request.callback == spider.parse_detail_page:
+            continue
+        response = HtmlResponse(request.url, body=SITE[request.url], encoding='utf-8', request=request)
+        for entry in mw.process_spider_output(response, request.callback(response)):
+            scheduler.enqueue_request(entry)
+        if max_listings is not None and sum(url.startswith(CATEGORY + '?') for url in fetched) >= max_listings:
+            break
+    return fetched
+
+
+def home_request(spider):
+    return scrapy.Request(HOME, spider.parse_region_home, meta={'region_domain': 'nn'}, priority=spider.DISCOVERY_PRIORITY)
+
+
+def test_details_are_drained_before_next_listing_page(tmp_path):
+    crawler, mw = make_crawl(tmp_path)
+    fetched = run(crawler, mw, [home_request(crawler.spider)])
+    mw.spider_closed(crawler.spider)
+
+    expected = [HOME, CATEGORY]
+    for page in range(1, PAGES + 1):
+        expected.append(listing_url(page))
+        expected.extend(detail_url(page, n) for n in range(ADS_PER_PAGE))
+    assert fetched == expected
+
+    stats = crawler.stats
+    assert stats.get_value('listing_overflow/pushed') == PAGES - 2
+    assert stats.get_value('listing_overflow/released') == PAGES - 2
+    assert stats.get_value('listing_overflow/peak_pending') == 2
+
+
+def test_overflow_pages_resume_from_disk(tmp_path):
+    crawler, mw = make_crawl(tmp_path)
+    fetched = run(crawler, mw, [home_request(crawler.spider)], max_listings=2)
+    # обход прерван: в планировщике две страницы списка, остальные ждут на диске
+    mw.spider_closed(crawler.spider)
+    assert listing_url(4) not in fetched
+
+    resumed_crawler, resumed_mw = make_crawl(tmp_path)
+    resumed = run(resumed_crawler, resumed_mw)
+    resumed_mw.spider_closed(resumed_crawler.spider)
+
+    listings = [url for url in resumed if url.startswith(CATEGORY + '?')]
+    assert listings == [listing_url(page) for page in range(5, PAGES + 1)]
+    assert detail_url(PAGES, 0) in resumed
+
+
+def test_failed_listing_frees_its_slot(tmp_path):
+    crawler, mw = make_crawl(tmp_path)
+    spider = crawler.spider
+    pages = [
+        scrapy.Request(listing_url(page), spider.parse_listing_page, meta={'region_domain': 'nn'})
+        for page in range(1, 5)
+    ]
+    category = scrapy.Request(CATEGORY, spider.parse_category_pages, meta={'region_domain': 'nn'})
+    response = HtmlResponse(CATEGORY, body=b'', request=category)
+    assert list(mw.process_spider_output(response, pages)) == pages[:2]
+
+    # HttpError на странице списка: место освобождается сразу, следующая страница уходит движку
+    failed = HtmlResponse(pages[0].url, status=500, body=b'', request=pages[0])
+    assert mw.process_spider_exception(failed, Exception()) is None
+    assert crawler.engine.scheduler.next_request().url == listing_url(3)
+    assert mw.pending['nn'] == 2
+    assert crawler.stats.get_value('listing_overflow/released') == 1
+    mw.spider_closed(spider)
@@ -0,0 +1,183 @@
+import pytest
+
+scrapy = pytest.importorskip('scrapy')
+
+from scrapy.exceptions import DontCloseSpider
+from scrapy.http import HtmlResponse
+from scrapy.utils.test import get_crawler
+
+from nmls_scraper.middlewares import RegionQuotaSpiderMiddleware, download_failed
+
+
+class QuotaSpider(scrapy.Spider):
+    name = 'quota_test'
+
+    def parse_region_home(self, response):
+        pass
+
+    def parse_category_pages(self, response):
+        pass
+
+    def parse_listing_page(self, response):
+        pass
+
+    def parse_detail_page(self, response):
+        pass
+
+
+class StubEngine:
+    def __init__(self):
+        self.crawled = []
+        self.close_reason = None
+
+    def crawl(self, request):
+        self.crawled.append(request)
+
+    def close_spider_async(self, reason='cancelled'):
+        self.close_reason = reason
+
+
+def make_middleware(**settings):
+    crawler = get_crawler(QuotaSpider, {
+        'REGION_QUOTA_ENABLED': True,
+        'REGION_QUOTA_DETAILS_PER_PAGE': 10,
+        **settings,
+    })
+    crawler.spider = QuotaSpider()
+    crawler.engine = StubEngine()
+    mw = RegionQuotaSpiderMiddleware.from_crawler(crawler)
+    return crawler, mw
+
+
+def meta(region, cat_id=1):
+    return {'region_domain': region, 'cat_id': cat_id, 'advt_type_id': 2}
+
+
+def category(spider, region, cat_id=1):
+    return scrapy.Request(f'https://{region}.example/cat{cat_id}', spider.parse_category_pages, meta=meta(region, cat_id))
+
+
+def listing(spider, region, page, cat_id=1):
+    return scrapy.Request(f'https://{region}.example/cat{cat_id}?page={page}', spider.parse_listing_page, meta=meta(region, cat_id))
+
+
+def detail(spider, region, n, cat_id=1):
+    return scrapy.Request(f'https://{region}.example/ad/id{cat_id}_{n}', spider.parse_detail_page, meta=meta(region, cat_id))
+
+
+def admit(mw, requests):
+    return [r for r in requests if mw._admit(r)]
+
+
+def respond(mw, request, result=()):
+    response = HtmlResponse(request.url, body=b'<html></html>', request=request)
+    return list(mw.process_spider_output(response, list(result)))
+
+
+def scope(region, cat_id=1):
+    return (region, cat_id, 2)
+
+
+def test_unused_share_of_small_region_goes_to_big_region():
+    crawler, mw = make_middleware(REGION_QUOTA_BUDGET=40)
+    spider = crawler.spider
+    cat_a, cat_b = admit(mw, [category(spider, 'a'), category(spider, 'b')])
+
+    # у региона a одна страница списка, у b - десять; по 10 объявлений на страницу квоты 20 и 20
+    [page_a] = respond(mw, cat_a, [listing(spider, 'a', 1)])
+    pages_b = respond(mw, cat_b, [listing(spider, 'b', n) for n in range(1, 11)])
+    assert len(pages_b) == 2
+    assert mw.parked[(scope('b'), 'listing')] == 8
+
+    # с единственной страницы региона a пришло 5 объявлений - оставшиеся 35 достаются b
+    details_a = respond(mw, page_a, [detail(spider, 'a', n) for n in range(5)])
+    assert len(details_a) == 5
+    assert scope('a') in mw.done_scopes
+    assert mw._quota(scope('b')) == 35
+    # теперь со страницы ожидается 5 объявлений: (2 + 5) * 5 = 35
+    assert len(crawler.engine.crawled) == 5
+    assert mw.parked[(scope('b'), 'listing')] == 3
+
+
+def test_region_and_category_weights():
+    crawler, mw = make_middleware(
+        REGION_QUOTA_BUDGET=40,
+        REGION_QUOTA_REGION_WEIGHTS={'a': 3},
+        REGION_QUOTA_CATEGORY_WEIGHTS={2: 3},
+    )
+    spider = crawler.spider
+    admit(mw, [category(spider, 'a', 1), category(spider, 'a', 2), category(spider, 'b', 1)])
+
+    assert mw._quota(scope('a', 1)) == 7.5
+    assert mw._quota(scope('a', 2)) == 22.5
+    assert mw._quota(scope('b', 1)) == 10
+
+
+def test_failed_download_releases_region_share():
+    crawler, mw = make_middleware(REGION_QUOTA_BUDGET=20)
+    spider = crawler.spider
+    cat_a, cat_b = admit(mw, [category(spider, 'a'), category(spider, 'b')])
+    [page_a] = respond(mw, cat_a, [listing(spider, 'a', 1)])
+    assert len(respond(mw, cat_b, [listing(spider, 'b', n) for n in range(1, 6)])) == 1
+
+    # страница региона a окончательно не скачалась - его доля сразу переходит к b, не дожидаясь простоя
+    crawler.signals.send_catch_log(download_failed, request=page_a, exception=IOError(), spider=spider)
+    assert scope('a') in mw.done_scopes
+    assert mw._quota(scope('b')) == 20
+    assert len(crawler.engine.crawled) == 1
+
+    # повторное сообщение об уже учтенном запросе ничего не меняет
+    crawler.signals.send_catch_log(download_failed, request=page_a, exception=IOError(), spider=spider)
+    assert len(crawler.engine.crawled) == 1
+
+
+def test_failed_detail_returns_its_place():
+    crawler, mw = make_middleware(REGION_QUOTA_BUDGET=4)
+    spider = crawler.spider
+    cat_a, cat_b = admit(mw, [category(spider, 'a'), category(spider, 'b')])
+    [page_a] = respond(mw, cat_a, [listing(spider, 'a', 1)])
+    first, second = respond(mw, page_a, [detail(spider, 'a', n) for n in range(3)])
+    assert mw.parked[(scope('a'), 'detail')] == 1
+
+    crawler.signals.send_catch_log(download_failed, request=first, exception=IOError(), spider=spider)
+    [third] = crawler.engine.crawled
+    assert third.url.endswith('id1_2')
+    assert mw.scheduled[scope('a')] == 2
+
+
+def test_spider_closes_when_budget_is_spent():
+    crawler, mw = make_middleware(REGION_QUOTA_BUDGET=3)
+    spider = crawler.spider
+    [cat_a] = admit(mw, [category(spider, 'a')])
+    [page_a] = respond(mw, cat_a, [listing(spider, 'a', 1)])
+    details = respond(mw, page_a, [detail(spider, 'a', n) for n in range(5)])
+    assert len(details) == 3
+
+    for request in details[:-1]:
+        respond(mw, request)
+    assert crawler.engine.close_reason is None
+
+    # последнее запрошенное объявление получено - бюджет израсходован
+    respond(mw, details[-1])
+    assert crawler.engine.close_reason == 'region_quota_spent'
+    assert crawler.stats.get_value('region_quota/dropped') == 2
+    assert crawler.engine.crawled == []
+
+
+def test_spider_idle_releases_parked_pages():
+    crawler, mw = make_middleware(REGION_QUOTA_BUDGET=20)
+    spider = crawler.spider
+    [cat_a] = admit(mw, [category(spider, 'a')])
+    assert len(respond(mw, cat_a, [listing(spider, 'a', n) for n in range(1, 6)])) == 2
+
+    # ответы на две страницы так и не пришли: в простое они считаются завершенными
+    with pytest.raises(DontCloseSpider):
+        mw.spider_idle(spider)
+    assert len(crawler.engine.crawled) == 2
+
+    with pytest.raises(DontCloseSpider):
+        mw.spider_idle(spider)
+    assert len(crawler.engine.crawled) == 3
+
+    mw.spider_idle(spider)
+    assert scope('a') in mw.done_scopes